@@ -3,6 +3,7 @@ import os
 import sys
 import json
 import time
+import shlex
 import shutil
 import locale
 import socket
@@ -10,7 +11,9 @@ import logging
 import platform
 import subprocess
 import cProfile
+import concurrent.futures
 import importlib # pylint: disable=deprecated-module
+import importlib.metadata
 
 
 class Dot(dict): # dot notation access to dictionary attributes
@@ -19,14 +22,17 @@ class Dot(dict): # dot notation access to dictionary attributes
     __delattr__ = dict.__delitem__
 
 
-pkg_resources, setuptools, distutils = None, None, None # defined via ensure_base_requirements
+setuptools, distutils = None, None # defined via ensure_base_requirements
 version = None
 current_branch = None
 log = logging.getLogger("sd")
 console = None
 debug = log.debug if os.environ.get('SD_INSTALL_DEBUG', None) is not None else lambda *args, **kwargs: None
 pip_log = '--log pip.log ' if os.environ.get('SD_PIP_DEBUG', None) is not None else ''
-log_file = os.path.join(os.path.dirname(__file__), 'sdnext.log')
+script_path = os.path.dirname(os.path.abspath(__file__))
+log_file = os.path.join(script_path, 'sdnext.log')
+version_cache = os.path.join(os.path.expanduser('~'), '.cache', 'sdnext', 'version.json')
+version_ttl = 900 # seconds before cached latest version is fetched again
 hostname = socket.gethostname()
 log_rolled = False
 first_call = True
@@ -256,20 +262,30 @@ def print_profile(profiler: cProfile.Profile, msg: str):
 
 @lru_cache()
 def package_version(package):
-    try:
-        return pkg_resources.get_distribution(package).version
-    except Exception:
-        return None
+    spec = package_spec(package)
+    return spec.version if spec is not None else None
 
 
 @lru_cache()
 def package_spec(package):
-    spec = pkg_resources.working_set.by_key.get(package, None) # more reliable than importlib
-    if spec is None:
-        spec = pkg_resources.working_set.by_key.get(package.lower(), None) # check name variations
-    if spec is None:
-        spec = pkg_resources.working_set.by_key.get(package.replace('_', '-'), None) # check name variations
-    return spec
+    for name in [package, package.lower(), package.replace('_', '-')]: # check name variations
+        try:
+            return importlib.metadata.distribution(name)
+        except Exception:
+            pass
+    return None
+
+
+def list_packages():
+    return [f'{dist.metadata["Name"]}=={dist.version}' for dist in importlib.metadata.distributions()]
+
+
+# package metadata changes after pip runs so cached lookups must be rebuilt
+def refresh_packages():
+    importlib.invalidate_caches()
+    package_spec.cache_clear()
+    package_version.cache_clear()
+    installed.cache_clear()
 
 
 # check if package is installed
@@ -279,10 +295,7 @@ def installed(package, friendly: str = None, reload = False, quiet = False): # p
     ok = True
     try:
         if reload:
-            try:
-                importlib.reload(pkg_resources)
-            except Exception:
-                pass
+            refresh_packages()
         if friendly:
             pkgs = friendly.split()
         else:
@@ -327,6 +340,7 @@ def uninstall(package, quiet = False):
             if not quiet:
                 log.warning(f'Package: {p} uninstall')
             res += pip(f"uninstall {p} --yes --quiet", ignore=True, quiet=True, uv=False)
+            refresh_packages()
     ts('uninstall', t_start)
     return res
 
@@ -341,6 +355,13 @@ def run(cmd: str, arg: str):
     return txt
 
 
+# build command without shell so each call does not spawn shell process, windows parses quoted command line natively
+def command(cmd: str, arg: str):
+    if sys.platform == 'win32':
+        return f'"{cmd}" {arg}'
+    return [cmd] + shlex.split(arg)
+
+
 @lru_cache()
 def pip(arg: str, ignore: bool = False, quiet: bool = True, uv = True):
     t_start = time.time()
@@ -355,18 +376,17 @@ def pip(arg: str, ignore: bool = False, quiet: bool = True, uv = True):
     all_args = f'{pip_log}{arg} {env_args}'.strip()
     if not quiet:
         log.debug(f'Running: {pipCmd}="{all_args}"')
-    result = subprocess.run(f'"{sys.executable}" -m {pipCmd} {all_args}', shell=True, check=False, env=os.environ, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    txt = result.stdout.decode(encoding="utf8", errors="ignore")
-    if len(result.stderr) > 0:
-        if uv and result.returncode != 0:
-            err = result.stderr.decode(encoding="utf8", errors="ignore")
-            log.warning('Install: cannot use uv, fallback to pip')
-            debug(f'Install: uv pip error: {err}')
-            return pip(originalArg, ignore, quiet, uv=False)
-        else:
-            txt += ('\n' if len(txt) > 0 else '') + result.stderr.decode(encoding="utf8", errors="ignore")
-    txt = txt.strip()
-    debug(f'Install {pipCmd}: {txt}')
+    lines = []
+    with subprocess.Popen(command(sys.executable, f'-m {pipCmd} {all_args}'), shell=False, env=os.environ, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding="utf8", errors="ignore", bufsize=1) as result:
+        for line in result.stdout: # stream output as it arrives instead of buffering until pip exits
+            line = line.rstrip()
+            debug(f'Install {pipCmd}: {line}')
+            lines.append(line)
+    txt = '\n'.join(lines).strip()
+    if uv and result.returncode != 0:
+        log.warning('Install: cannot use uv, fallback to pip')
+        debug(f'Install: uv pip error: {txt}')
+        return pip(originalArg, ignore, quiet, uv=False)
     if result.returncode != 0 and not ignore:
         errors.append(f'pip: {package}')
         log.error(f'Install: {pipCmd}: {arg}')
@@ -387,10 +407,28 @@ def install(package, friendly: str = None, ignore: bool = False, reinstall: bool
         deps = '' if not no_deps else '--no-deps '
         cmd = f"install{' --upgrade' if not args.uv else ''}{' --force' if force else ''} {deps}{package}"
         res = pip(cmd, ignore=ignore, uv=package != "uv" and not package.startswith('git+'))
-        try:
-            importlib.reload(pkg_resources)
-        except Exception:
-            pass
+        refresh_packages()
+    ts('install', t_start)
+    return res
+
+
+# install multiple packages using single pip call so pip startup and resolver run only once
+def install_batch(packages: list, ignore: bool = False):
+    t_start = time.time()
+    res = ''
+    if len(packages) == 0:
+        return res
+    if args.reinstall or args.upgrade:
+        global quick_allowed # pylint: disable=global-statement
+        quick_allowed = False
+    cmd = f"install{' --upgrade' if not args.uv else ''} {' '.join(packages)}"
+    res = pip(cmd, ignore=True, uv=not any(p.startswith('git+') for p in packages)) # failures are reported per package below
+    refresh_packages()
+    failed = [p for p in packages if not installed(p, quiet=True)]
+    if len(failed) > 0: # single bad spec fails entire batch so retry individually
+        log.debug(f'Install: batch failed packages={failed} retrying individually')
+        for p in failed:
+            res += '\n' + install(p, ignore=ignore)
     ts('install', t_start)
     return res
 
@@ -406,7 +444,13 @@ def git(arg: str, folder: str = None, ignore: bool = False, optional: bool = Fal
     git_cmd = os.environ.get('GIT', "git")
     if git_cmd != "git":
         git_cmd = os.path.abspath(git_cmd)
-    result = subprocess.run(f'"{git_cmd}" {arg}', check=False, shell=True, env=os.environ, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=folder or '.')
+    try:
+        result = subprocess.run(command(git_cmd, arg), check=False, shell=False, env=os.environ, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=folder or '.')
+    except OSError as e: # executable not found is raised instead of reported by shell
+        if not ignore:
+            errors.append(f'git: {folder}')
+            log.error(f'Git: {folder} / {arg} {e}')
+        return str(e)
     txt = result.stdout.decode(encoding="utf8", errors="ignore")
     if len(result.stderr) > 0:
         txt += ('\n' if len(txt) > 0 else '') + result.stderr.decode(encoding="utf8", errors="ignore")
@@ -457,21 +501,17 @@ def branch(folder=None):
 # update git repository
 def update(folder, keep_branch = False, rebase = True):
     t_start = time.time()
-    try:
-        git('config rebase.Autostash true')
-    except Exception:
-        pass
     arg = '--rebase --force' if rebase else ''
     if keep_branch:
-        res = git(f'pull {arg}', folder)
+        res = git(f'-c rebase.autoStash=true pull {arg}', folder) # per-command setting instead of config write which races between concurrent updates
         debug(f'Install update: folder={folder} args={arg} {res}')
         return res
     b = branch(folder)
-    if branch is None:
-        res = git(f'pull {arg}', folder)
+    if b is None:
+        res = git(f'-c rebase.autoStash=true pull {arg}', folder)
         debug(f'Install update: folder={folder} branch={b} args={arg} {res}')
     else:
-        res = git(f'pull origin {b} {arg}', folder)
+        res = git(f'-c rebase.autoStash=true pull origin {b} {arg}', folder)
         debug(f'Install update: folder={folder} branch={b} args={arg} {res}')
     if not args.experimental:
         commit = extensions_commit.get(os.path.basename(folder), None)
@@ -490,15 +530,17 @@ def clone(url, folder, commithash=None):
             update(folder)
         else:
             current_hash = git('rev-parse HEAD', folder).strip()
-            if current_hash != commithash:
+            if not current_hash.startswith(commithash): # pinned hash may be abbreviated
                 res = git('fetch', folder)
                 debug(f'Install clone: {res}')
                 git(f'checkout {commithash}', folder)
                 return
     else:
         log.info(f'Cloning repository: {url}')
-        git(f'clone "{url}" "{folder}"')
-        if commithash is not None:
+        if commithash is None:
+            git(f'clone --filter=blob:none "{url}" "{folder}"') # blobless clone keeps full commit history for later pulls but only downloads files of checked out commit
+        else:
+            git(f'clone --filter=blob:none --no-checkout "{url}" "{folder}"')
             git(f'-C "{folder}" checkout {commithash}')
     ts('clone', t_start)
 
@@ -562,14 +604,14 @@ def check_diffusers():
     if args.skip_all or args.skip_git or args.experimental:
         return
     sha = '00f95b9755718aabb65456e791b8408526ae6e76' # diffusers commit hash
-    pkg = pkg_resources.working_set.by_key.get('diffusers', None)
-    minor = int(pkg.version.split('.')[1] if pkg is not None else 0)
+    pkg = package_version('diffusers')
+    minor = int(pkg.split('.')[1] if pkg is not None else 0)
     cur = opts.get('diffusers_version', '') if minor > 0 else ''
     if (minor == 0) or (cur != sha):
         if minor == 0:
             log.info(f'Diffusers install: commit={sha}')
         else:
-            log.info(f'Diffusers update: package={pkg} current={cur} target={sha}')
+            log.info(f'Diffusers update: version={pkg} current={cur} target={sha}')
             pip('uninstall --yes diffusers', ignore=True, quiet=True, uv=False)
         pip(f'install --upgrade git+https://github.com/huggingface/diffusers@{sha}', ignore=False, quiet=True, uv=False)
         global diffusers_commit # pylint: disable=global-statement
@@ -913,7 +955,7 @@ def check_torch():
                 try:
                     if args.use_directml and allow_directml:
                         import torch_directml # pylint: disable=import-error
-                        dml_ver = pkg_resources.get_distribution("torch-directml")
+                        dml_ver = package_version("torch-directml")
                         log.info(f'Torch backend: DirectML ({dml_ver})')
                         for i in range(0, torch_directml.device_count()):
                             log.info(f'Torch detected GPU: {torch_directml.device_name(i)}')
@@ -1015,13 +1057,19 @@ def run_extension_installer(folder):
         log.error(f'Extension installer exception: {e}')
 
 
+# folder mtime and disabled list are part of key so cache is invalidated when extensions or options change
+@lru_cache(maxsize=8)
+def list_extensions_cached(folder, mtime, disabled_extensions): # pylint: disable=unused-argument
+    return tuple(x for x in os.listdir(folder) if os.path.isdir(os.path.join(folder, x)) and x not in disabled_extensions and not x.startswith('.'))
+
+
 # get list of all enabled extensions
 def list_extensions_folder(folder, quiet=False):
     disabled_extensions_all = opts.get('disable_all_extensions', 'none')
     if disabled_extensions_all != 'none':
         return []
-    disabled_extensions = opts.get('disabled_extensions', [])
-    enabled_extensions = [x for x in os.listdir(folder) if os.path.isdir(os.path.join(folder, x)) and x not in disabled_extensions and not x.startswith('.')]
+    disabled_extensions = tuple(opts.get('disabled_extensions', []))
+    enabled_extensions = list(list_extensions_cached(folder, os.path.getmtime(folder), disabled_extensions))
     if not quiet:
         log.info(f'Extensions: path="{folder}" enabled={enabled_extensions}')
     return enabled_extensions
@@ -1032,8 +1080,7 @@ def install_extensions(force=False):
     if args.profile:
         pr = cProfile.Profile()
         pr.enable()
-    pkg_resources._initialize_master_working_set() # pylint: disable=protected-access
-    pkgs = [f'{p.project_name}=={p._version}' for p in pkg_resources.working_set] # pylint: disable=protected-access,not-an-iterable
+    pkgs = list_packages()
     log.debug(f'Installed packages: {len(pkgs)}')
     from modules.paths import extensions_builtin_dir, extensions_dir
     extensions_duplicates = []
@@ -1041,6 +1088,7 @@ def install_extensions(force=False):
     extensions_disabled = [e.lower() for e in opts.get('disabled_extensions', [])]
     extension_folders = [extensions_builtin_dir] if args.safe else [extensions_builtin_dir, extensions_dir]
     res = []
+    tasks = []
     for folder in extension_folders:
         if not os.path.isdir(folder):
             continue
@@ -1049,33 +1097,41 @@ def install_extensions(force=False):
         for ext in extensions:
             if os.path.basename(ext).lower() in extensions_disabled:
                 continue
-            t_start = time.time()
             if ext in extensions_enabled:
                 extensions_duplicates.append(ext)
                 continue
             extensions_enabled.append(ext)
-            if args.upgrade or force:
-                try:
-                    res.append(update(os.path.join(folder, ext)))
-                except Exception:
-                    res.append(f'Extension update error: {os.path.join(folder, ext)}')
-                    log.error(f'Extension update error: {os.path.join(folder, ext)}')
-            if not args.skip_extensions:
-                commit = extensions_commit.get(os.path.basename(ext), None)
-                if commit is not None:
-                    log.debug(f'Extension force: name="{ext}" commit={commit}')
-                    res.append(git(f'checkout {commit}', os.path.join(folder, ext)))
-                run_extension_installer(os.path.join(folder, ext))
-            pkg_resources._initialize_master_working_set() # pylint: disable=protected-access
-            try:
-                updated = [f'{p.project_name}=={p._version}' for p in pkg_resources.working_set] # pylint: disable=protected-access,not-an-iterable
-                diff = [x for x in updated if x not in pkgs]
-                pkgs = updated
-                if len(diff) > 0:
-                    log.info(f'Extension installed packages: {ext} {diff}')
-            except Exception as e:
-                log.error(f'Extension installed unknown package: {e}')
-            ts(ext, t_start)
+            tasks.append((folder, ext))
+
+    def update_extension(task):
+        folder, ext = task
+        try:
+            return update(os.path.join(folder, ext))
+        except Exception:
+            log.error(f'Extension update error: {os.path.join(folder, ext)}')
+            return f'Extension update error: {os.path.join(folder, ext)}'
+
+    if args.upgrade or force: # git updates are independent per extension so run them concurrently
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            res.extend(executor.map(update_extension, tasks))
+    for folder, ext in tasks: # installers run sequentially since they install packages into same environment
+        t_start = time.time()
+        if not args.skip_extensions:
+            commit = extensions_commit.get(os.path.basename(ext), None)
+            if commit is not None:
+                log.debug(f'Extension force: name="{ext}" commit={commit}')
+                res.append(git(f'checkout {commit}', os.path.join(folder, ext)))
+            run_extension_installer(os.path.join(folder, ext))
+        importlib.invalidate_caches()
+        try:
+            updated = list_packages()
+            diff = [x for x in updated if x not in pkgs]
+            pkgs = updated
+            if len(diff) > 0:
+                log.info(f'Extension installed packages: {ext} {diff}')
+        except Exception as e:
+            log.error(f'Extension installed unknown package: {e}')
+        ts(ext, t_start)
     log.info(f'Extensions enabled: {extensions_enabled}')
     if len(extensions_duplicates) > 0:
         log.warning(f'Extensions duplicates: {extensions_duplicates}')
@@ -1099,19 +1155,25 @@ def install_submodules(force=True):
         txt = git('submodule')
         git_reset()
         log.info('Continuing setup')
-    git('submodule --quiet update --init --recursive')
+    git('submodule --quiet update --init --recursive --jobs 8')
     git('submodule --quiet sync --recursive')
     submodules = txt.splitlines()
     res = []
-    for submodule in submodules:
+
+    def update_submodule(submodule):
         try:
             name = submodule.split()[1].strip()
             if args.upgrade:
-                res.append(update(name))
-            else:
-                branch(name)
+                return update(name)
+            branch(name)
         except Exception:
             log.error(f'Submodule update error: {submodule}')
+        return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor: # each submodule is a separate repo so updates are independent
+        for r in executor.map(update_submodule, submodules):
+            if r is not None:
+                res.append(r)
     setup_logging()
     if args.profile:
         pr.disable()
@@ -1139,7 +1201,7 @@ def ensure_base_requirements():
     setuptools_version = '69.5.1'
 
     def update_setuptools():
-        global pkg_resources, setuptools, distutils # pylint: disable=global-statement
+        global setuptools, distutils # pylint: disable=global-statement
         # python may ship with incompatible setuptools
         subprocess.run(f'"{sys.executable}" -m pip install setuptools=={setuptools_version}', shell=True, check=False, env=os.environ, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         # need to delete all references to modules to be able to reload them otherwise python will use cached version
@@ -1150,12 +1212,9 @@ def ensure_base_requirements():
         sys.modules['setuptools'] = setuptools
         distutils = importlib.import_module('distutils')
         sys.modules['distutils'] = distutils
-        pkg_resources = importlib.import_module('pkg_resources')
-        sys.modules['pkg_resources'] = pkg_resources
 
     try:
-        global pkg_resources, setuptools # pylint: disable=global-statement
-        import pkg_resources # pylint: disable=redefined-outer-name
+        global setuptools # pylint: disable=global-statement
         import setuptools # pylint: disable=redefined-outer-name
         if setuptools.__version__ != setuptools_version:
             update_setuptools()
@@ -1227,9 +1286,10 @@ def install_requirements():
     log.info('Install: verifying requirements')
     with open('requirements.txt', 'r', encoding='utf8') as f:
         lines = [line.strip() for line in f.readlines() if line.strip() != '' and not line.startswith('#') and line is not None]
-        for line in lines:
-            if not installed(line, quiet=True):
-                _res = install(line)
+    needed = [line for line in lines if not installed(line, quiet=True)]
+    if len(needed) > 0:
+        log.debug(f'Install: requirements={needed}')
+        _res = install_batch(needed)
     if args.profile:
         pr.disable()
         print_profile(pr, 'Requirements')
@@ -1286,23 +1346,28 @@ def check_extensions():
         log.info(f'Extensions: disabled={disabled_extensions_all}')
     else:
         log.info(f'Extensions: disabled={opts.get("disabled_extensions", [])}')
+
+    def newest_mtime(extension_dir):
+        newest = 0
+        if not os.path.isdir(extension_dir):
+            log.debug(f'Extension listed as installed but folder missing: {extension_dir}')
+            return newest
+        with os.scandir(extension_dir) as entries: # entries carry cached stat so no path join and separate lookup per file
+            for entry in entries:
+                if '.json' in entry.name or '.csv' in entry.name or '__pycache__' in entry.name:
+                    continue
+                newest = max(newest, entry.stat().st_mtime)
+        # log.debug(f'Extension version: {time.ctime(newest)} {extension_dir}')
+        return newest
+
+    extension_dirs = []
     for folder in extension_folders:
         if not os.path.isdir(folder):
             continue
         extensions = list_extensions_folder(folder)
-        for ext in extensions:
-            newest = 0
-            extension_dir = os.path.join(folder, ext)
-            if not os.path.isdir(extension_dir):
-                log.debug(f'Extension listed as installed but folder missing: {extension_dir}')
-                continue
-            for f in os.listdir(extension_dir):
-                if '.json' in f or '.csv' in f or '__pycache__' in f:
-                    continue
-                mtime = os.path.getmtime(os.path.join(extension_dir, f))
-                newest = max(newest, mtime)
-            newest_all = max(newest_all, newest)
-            # log.debug(f'Extension version: {time.ctime(newest)} {folder}{os.path.sep}{ext}')
+        extension_dirs += [os.path.join(folder, ext) for ext in extensions]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor: # stat latency overlaps across folders on slow disks
+        newest_all = max([newest_all, *executor.map(newest_mtime, extension_dirs)])
     return round(newest_all)
 
 
@@ -1402,6 +1467,39 @@ def check_venv():
     ts('venv', t_start)
 
 
+# get latest commit info for branch from github, cached on disk so warm starts skip network roundtrip
+def get_latest(branch_name, force=False):
+    try:
+        with open(version_cache, 'r', encoding='utf8') as f:
+            cache = json.load(f)
+    except Exception:
+        cache = {}
+    cached = cache.get(branch_name, {})
+    if not force and cached.get('commit', None) is not None and time.time() - cached.get('time', 0) < version_ttl:
+        return cached['commit']
+    try:
+        import requests
+    except ImportError:
+        return None
+    headers = { 'If-None-Match': cached['etag'] } if cached.get('etag', None) is not None else {}
+    res = requests.get(f'https://api.github.com/repos/vladmandic/sdnext/branches/{branch_name}', headers=headers, timeout=10)
+    if res.status_code == 304 and cached.get('commit', None) is not None: # not modified does not count against rate limit
+        commit = cached['commit']
+    elif res.status_code == 200:
+        commit = res.json()
+    else:
+        return res.json()
+    cache[branch_name] = { 'time': time.time(), 'etag': res.headers.get('ETag', None), 'commit': commit }
+    try:
+        os.makedirs(os.path.dirname(version_cache), exist_ok=True)
+        with open(f'{version_cache}.tmp', 'w', encoding='utf8') as f:
+            json.dump(cache, f)
+        os.replace(f'{version_cache}.tmp', version_cache)
+    except Exception as e:
+        debug(f'Version cache: file="{version_cache}" {e}')
+    return commit
+
+
 # check version of the main repo and optionally upgrade it
 def check_version(offline=False, reset=True): # pylint: disable=unused-argument
     t_start = time.time()
@@ -1421,13 +1519,11 @@ def check_version(offline=False, reset=True): # pylint: disable=unused-argument
     git_commit = commit[:7]
     if args.quick:
         return
-    try:
-        import requests
-    except ImportError:
-        return
     commits = None
     try:
-        commits = requests.get(f'https://api.github.com/repos/vladmandic/sdnext/branches/{branch_name}', timeout=10).json()
+        commits = get_latest(branch_name, force=args.upgrade) # upgrade must compare against current remote
+        if commits is None:
+            return
         if commits['commit']['sha'] != commit and args.upgrade:
             global quick_allowed # pylint: disable=global-statement
             quick_allowed = False
@@ -1460,7 +1556,7 @@ def update_wiki():
     if args.upgrade:
         log.info('Updating Wiki')
         try:
-            update(os.path.join(os.path.dirname(__file__), "wiki"))
+            update(os.path.join(script_path, "wiki"))
         except Exception:
             log.error('Wiki update error')
     ts('wiki', t_start)
@@ -1557,7 +1653,6 @@ def parse_args(parser):
     # command line args
     global args # pylint: disable=global-statement
     if "USED_VSCODE_COMMAND_PICKARGS" in os.environ:
-        import shlex
         argv = shlex.split(" ".join(sys.argv[1:])) if "USED_VSCODE_COMMAND_PICKARGS" in os.environ else sys.argv[1:]
         log.debug('VSCode Launch')
         args = parser.parse_args(argv)
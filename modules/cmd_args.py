@@ -154,8 +154,8 @@ def settings_args(opts, args):
     opts.enable_pnginfo = True
     opts.data['clip_skip'] = 1
 
-    opts.onchange("lora_dir", lambda: setattr(args, "lora_dir", opts.lora_dir))
-    opts.onchange("lyco_dir", lambda: setattr(args, "lyco_dir", opts.lyco_dir))
+    for attr in ('lora_dir', 'lyco_dir'): # keep args in sync with opts that replaced them
+        opts.onchange(attr, lambda attr=attr: setattr(args, attr, getattr(opts, attr)))
 
     if "USED_VSCODE_COMMAND_PICKARGS" in os.environ:
         import shlex
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import math
+import functools
 from dataclasses import dataclass
 from typing import List, Optional, Tuple, Union
 
@@ -20,22 +21,37 @@ import torch
 from diffusers.configuration_utils import ConfigMixin, register_to_config
 from diffusers.utils import BaseOutput
 from diffusers.schedulers.scheduling_utils import SchedulerMixin
+from modules import shared
+
+
+@functools.lru_cache(maxsize=8)
+def finfo_max(dtype):
+    return torch.finfo(dtype).max
 
 
 def gumbel_noise(t, generator=None):
-    noise = []
-    noise_shape = t.shape[1:]
-    for i in range(len(generator)):
-        device = generator[i].device if generator[i] is not None else t.device
-        noise.append(torch.zeros(noise_shape, device=device, dtype=t.dtype).uniform_(0, 1, generator=generator[i]).to(t.device))
-    noise = torch.stack(noise, dim=0)
-    return -torch.log((-torch.log(noise.clamp(1e-20))).clamp(1e-20))
-
-
-def mask_by_random_topk(mask_len, probs, temperature=1.0, generator=None):
-    confidence = torch.log(probs.clamp(1e-20)) + temperature * gumbel_noise(probs, generator=generator)
-    sorted_confidence = torch.sort(confidence, dim=-1).values
-    cut_off = torch.gather(sorted_confidence, 1, mask_len.long())
+    # always sample in fp32 as half precision uniform grid near 1 caps the noise and creates ties, and 1e-20 clamp underflows in fp16
+    if not isinstance(generator, list):
+        generator = [generator] * t.shape[0]
+    if all(g is generator[0] for g in generator): # single shared generator so sample entire batch at once
+        device = generator[0].device if generator[0] is not None else t.device
+        noise = torch.empty(t.shape, device=device, dtype=torch.float32).uniform_(0, 1, generator=generator[0]).to(t.device)
+    else: # per-sample generators must be sampled individually to preserve per-sample seeds
+        noise = []
+        noise_shape = t.shape[1:]
+        for i in range(len(generator)):
+            device = generator[i].device if generator[i] is not None else t.device
+            noise.append(torch.zeros(noise_shape, device=device, dtype=torch.float32).uniform_(0, 1, generator=generator[i]).to(t.device))
+        noise = torch.stack(noise, dim=0)
+    return noise.clamp_(1e-20).log_().neg_().clamp_(1e-20).log_().neg_() # in-place on freshly allocated noise
+
+
+def mask_by_random_topk(mask_len, log_probs, temperature=1.0, generator=None):
+    confidence = log_probs + temperature * gumbel_noise(log_probs, generator=generator)
+    # only the lowest mask_len+1 values per row are needed for the cut-off so avoid sorting entire row
+    k = min(int(mask_len.max()) + 1, confidence.shape[-1])
+    lowest_confidence = torch.topk(confidence, k, dim=-1, largest=False, sorted=True).values
+    cut_off = torch.gather(lowest_confidence, 1, mask_len.long())
     masking = confidence < cut_off
     return masking
 
@@ -71,6 +87,9 @@ class Scheduler(SchedulerMixin, ConfigMixin):
     ):
         self.temperatures = None
         self.timesteps = None
+        self.num_inference_steps = None
+        self.mask_ratios = None
+        self.generators = {}
 
     def set_timesteps(
         self,
@@ -78,13 +97,40 @@ class Scheduler(SchedulerMixin, ConfigMixin):
         temperature: Union[int, Tuple[int, int], List[int]] = (2, 0),
         device: Union[str, torch.device] = None,
     ):
-        self.timesteps = torch.arange(num_inference_steps, device=device).flip(0)
+        self.num_inference_steps = num_inference_steps
+        self.timesteps = torch.arange(num_inference_steps).flip(0) # keep on host so per-step index lookups do not sync device
+        self.generators = {}
 
         if isinstance(temperature, (tuple, list)):
             self.temperatures = torch.linspace(temperature[0], temperature[1], num_inference_steps, device=device)
         else:
             self.temperatures = torch.linspace(temperature, 0.01, num_inference_steps, device=device)
 
+        # masking schedule depends only on step count so compute it once as host-side floats
+        ratios = [(i + 1) / num_inference_steps for i in range(num_inference_steps)]
+        if self.config.masking_schedule == "cosine":
+            half_pi = math.pi / 2
+            self.mask_ratios = [math.cos(ratio * half_pi) for ratio in ratios]
+        elif self.config.masking_schedule == "linear":
+            self.mask_ratios = [1 - ratio for ratio in ratios]
+        else:
+            raise ValueError(f"unknown masking schedule {self.config.masking_schedule}")
+
+    def index_for_timestep(self, timestep) -> int:
+        # timesteps are always arange(num_inference_steps).flip(0) so index is direct instead of searching on device
+        return self.num_inference_steps - 1 - int(timestep)
+
+    def device_generator(self, generator, device):
+        # mirror generator on compute device once per run so noise is sampled in-place instead of copied every step
+        if generator is None or generator.device == device or shared.opts.diffusers_generator_device == "CPU":
+            return generator # cpu generator is explicitly requested for reproducibility across devices
+        if id(generator) not in self.generators:
+            try:
+                self.generators[id(generator)] = torch.Generator(device=device).manual_seed(generator.initial_seed())
+            except Exception:
+                self.generators[id(generator)] = generator # backend without device generators
+        return self.generators[id(generator)]
+
     def step(
         self,
         model_output: torch.Tensor,
@@ -95,61 +141,49 @@ class Scheduler(SchedulerMixin, ConfigMixin):
         return_dict: bool = True,
     ) -> Union[SchedulerOutput, Tuple]:
         two_dim_input = sample.ndim == 3 and model_output.ndim == 4
+        codebook_dim = -1
 
         if two_dim_input:
             batch_size, codebook_size, height, width = model_output.shape
             sample = sample.reshape(batch_size, height * width)
-            model_output = model_output.reshape(batch_size, codebook_size, height * width).permute(0, 2, 1)
+            # keep model layout [B, C, H*W] and reduce over codebook dim instead of permuting into a strided view
+            model_output = model_output.reshape(batch_size, codebook_size, height * width)
+            codebook_dim = 1
 
         unknown_map = sample == self.config.mask_token_id
 
-        probs = model_output.softmax(dim=-1)
-        device = probs.device
-        probs_view_shape = probs.shape[1:-1]
+        log_probs = torch.nn.functional.log_softmax(model_output.float(), dim=codebook_dim) # log-domain is reused by sampling and masking, fp32 so gumbel-max is an exact categorical draw
         if not isinstance(generator, list):
-            generator = [generator] * probs.size(0)
-        elif isinstance(generator, list) and len(generator) == 1 and len(generator) != probs.size(0):
-            generator = generator * probs.size(0)
+            generator = [generator] * log_probs.size(0)
+        elif isinstance(generator, list) and len(generator) == 1 and len(generator) != log_probs.size(0):
+            generator = generator * log_probs.size(0)
+        generator = [self.device_generator(g, log_probs.device) for g in generator]
 
-        pred_original_sample = []
-        for i in range(len(generator)):
-            probs_ = probs[i].to(generator[i].device) if generator[i] is not None else probs[i] # handles when generator is on CPU
-            if probs_.device.type == "cpu" and probs_.dtype != torch.float32:
-                probs_ = probs_.float()  # multinomial is not implemented for cpu half precision
-            pred_original_sample.append(torch.multinomial(probs_, 1, generator=generator[i]).to(device=device).view(*probs_view_shape))
-        pred_original_sample = torch.stack(pred_original_sample, dim=0)
+        # gumbel-max trick: argmax(log(p) + gumbel) is a categorical draw for the entire batch in one pass
+        pred_original_sample = (log_probs + gumbel_noise(log_probs, generator=generator)).argmax(dim=codebook_dim)
         pred_original_sample = torch.where(unknown_map, pred_original_sample, sample)
 
         if timestep == 0:
             prev_sample = pred_original_sample
         else:
             seq_len = sample.shape[1]
-            step_idx = (self.timesteps == timestep).nonzero()
-            ratio = (step_idx + 1) / len(self.timesteps)
-
-            if self.config.masking_schedule == "cosine":
-                mask_ratio = torch.cos(ratio * math.pi / 2)
-            elif self.config.masking_schedule == "linear":
-                mask_ratio = 1 - ratio
-            else:
-                raise ValueError(f"unknown masking schedule {self.config.masking_schedule}")
-
-            mask_ratio = starting_mask_ratio * mask_ratio
+            step_idx = self.index_for_timestep(timestep)
+            mask_ratio = starting_mask_ratio * self.mask_ratios[step_idx]
 
-            mask_len = (seq_len * mask_ratio).floor()
+            mask_len = math.floor(seq_len * mask_ratio)
             # do not mask more than amount previously masked
-            mask_len = torch.min(unknown_map.sum(dim=-1, keepdim=True) - 1, mask_len)
+            mask_len = (unknown_map.sum(dim=-1, keepdim=True) - 1).clamp_(max=mask_len)
             # mask at least one
-            mask_len = torch.max(torch.tensor([1], device=model_output.device), mask_len)
+            mask_len = mask_len.clamp_(min=1)
 
-            selected_probs = torch.gather(probs, -1, pred_original_sample[:, :, None])[:, :, 0]
+            selected_log_probs = torch.gather(log_probs, codebook_dim, pred_original_sample.unsqueeze(codebook_dim)).squeeze(codebook_dim)
             # Ignores the tokens given in the input by overwriting their confidence.
-            selected_probs = torch.where(unknown_map, selected_probs, torch.finfo(selected_probs.dtype).max)
+            selected_log_probs = selected_log_probs.masked_fill_(~unknown_map, finfo_max(selected_log_probs.dtype))
 
-            masking = mask_by_random_topk(mask_len, selected_probs, self.temperatures[step_idx], generator)
+            masking = mask_by_random_topk(mask_len, selected_log_probs, self.temperatures[step_idx], generator)
 
             # Masks tokens with lower confidence.
-            prev_sample = torch.where(masking, self.config.mask_token_id, pred_original_sample)
+            prev_sample = pred_original_sample.masked_fill(masking, self.config.mask_token_id)
 
         if two_dim_input:
             prev_sample = prev_sample.reshape(batch_size, height, width)
@@ -161,15 +195,8 @@ class Scheduler(SchedulerMixin, ConfigMixin):
         return SchedulerOutput(prev_sample, pred_original_sample)
 
     def add_noise(self, sample, timesteps, generator=None):
-        step_idx = (self.timesteps == timesteps).nonzero()
-        ratio = (step_idx + 1) / len(self.timesteps)
-
-        if self.config.masking_schedule == "cosine":
-            mask_ratio = torch.cos(ratio * math.pi / 2)
-        elif self.config.masking_schedule == "linear":
-            mask_ratio = 1 - ratio
-        else:
-            raise ValueError(f"unknown masking schedule {self.config.masking_schedule}")
+        step_idx = self.index_for_timestep(timesteps)
+        mask_ratio = self.mask_ratios[step_idx]
 
         mask_indices = (
             torch.rand(
@@ -178,8 +205,6 @@ class Scheduler(SchedulerMixin, ConfigMixin):
             < mask_ratio
         )
 
-        masked_sample = sample.clone()
-
-        masked_sample[mask_indices] = self.config.mask_token_id
+        masked_sample = sample.masked_fill(mask_indices, self.config.mask_token_id)
 
         return masked_sample
@@ -1,12 +1,15 @@
 import os
 import sys
 import time
+import zlib
 import inspect
+import weakref
+import itertools
 import torch
 import accelerate.hooks
 import accelerate.utils.modeling
 from installer import log
-from modules import shared, devices, errors, model_quant
+from modules import shared, devices, errors, hashes, memstats, model_quant
 from modules.timer import process as process_timer
 
 
@@ -16,26 +19,117 @@ offload_warn = ['sc', 'sd3', 'f1', 'h1', 'hunyuandit', 'auraflow', 'omnigen', 'o
 offload_post = ['h1']
 offload_hook_instance = None
 balanced_offload_exclude = ['CogView4Pipeline']
+balanced_offload_gc = 0.25 # gb that must be offloaded in a single pass before running gc
+balanced_offload_pinned = 0.25 # max fraction of system ram that can be page-locked for offload buffers
+pinned_memory = 0 # bytes currently held by pinned offload buffers across all hooks
 accelerate_dtype_byte_size = None
+fp8_dtypes = frozenset(getattr(torch, dtype) for dtype in ['float8_e4m3fn', 'float8_e4m3fnuz', 'float8_e5m2', 'float8_e5m2fnuz'] if hasattr(torch, dtype)) # older torch may not have defined dtypes
+copy_stream = None
+signature_cache = {}
 
 
 def dtype_byte_size(dtype: torch.dtype):
-    try:
-        if dtype in [torch.float8_e4m3fn, torch.float8_e4m3fnuz, torch.float8_e5m2, torch.float8_e5m2fnuz]:
-            dtype = accelerate.utils.modeling.CustomDtype.FP8
-    except Exception: # catch since older torch many not have defined dtypes
-        pass
+    if dtype in fp8_dtypes:
+        dtype = accelerate.utils.modeling.CustomDtype.FP8
     return accelerate_dtype_byte_size(dtype)
 
 
+def get_copy_stream():
+    # dedicated stream for weight transfers so they can overlap with compute already queued on the default stream
+    global copy_stream # pylint: disable=global-statement
+    if copy_stream is None and devices.backend in {'cuda', 'rocm'} and torch.cuda.is_available():
+        copy_stream = torch.cuda.Stream(device=devices.device)
+    return copy_stream
+
+
+def move_module(module, device):
+    stream = get_copy_stream()
+    if stream is None:
+        return module.to(device)
+    with torch.cuda.stream(stream):
+        module = module.to(device, non_blocking=True)
+    current = torch.cuda.current_stream()
+    for tensor in itertools.chain(module.parameters(), module.buffers()):
+        if tensor.device.type == 'cuda':
+            tensor.record_stream(current) # tensors allocated on copy stream are used by compute stream
+    current.wait_stream(stream)
+    return module
+
+
+def copy_buffers(buffers, sources, non_blocking=False):
+    if hasattr(torch, '_foreach_copy_'): # single dispatch for all copies
+        torch._foreach_copy_(buffers, sources, non_blocking=non_blocking) # pylint: disable=protected-access
+    else:
+        for buffer, source in zip(buffers, sources):
+            buffer.copy_(source, non_blocking=non_blocking)
+
+
+def wait_offload(module):
+    # pinned buffers of async offload must not be read until copy completes
+    event = getattr(module, "offload_event", None)
+    if event is not None:
+        event.synchronize()
+        module.offload_event = None
+
+
+def is_movable(module):
+    # bitsandbytes 8bit modules cannot be moved and 4bit only with recent bnb, check upfront instead of raising on every step
+    if getattr(module, "quantization_method", None) != 'bitsandbytes':
+        return True
+    return not (getattr(module, "is_loaded_in_8bit", False) or getattr(module, "offload_unmovable", False))
+
+
+def release_pinned(size):
+    global pinned_memory # pylint: disable=global-statement
+    pinned_memory -= size
+
+
+def pin_buffer(buffer, size):
+    # budget is shared by all hooks and released only when buffer is freed since buffers outlive hook instances
+    global pinned_memory # pylint: disable=global-statement
+    pinned_memory += size
+    weakref.finalize(buffer, release_pinned, size)
+
+
+def get_used_gpu():
+    # allocator query is much cheaper than full memory stats and does not synchronize device
+    # reserved includes cached blocks so it stays close to device-level used memory that thresholds were tuned against
+    if devices.cuda_ok or devices.backend == 'directml':
+        try:
+            if devices.backend == 'directml':
+                return torch.cuda.memory_allocated(devices.device) / 1024 / 1024 / 1024 # directml does not cache so allocated equals reserved
+            return torch.cuda.memory_reserved(devices.device) / 1024 / 1024 / 1024
+        except Exception:
+            pass
+    return devices.torch_gc(fast=True)[0]
+
+
+def get_size_prefix(checkpoint_name, module_name):
+    return f'{checkpoint_name}:{module_name}:'
+
+
+def get_size_key(checkpoint_name, module_name, module):
+    # module size only changes with model, dtype or quantization so include all of them in persisted key
+    quant = getattr(module, "quantization_method", None)
+    config = getattr(module, "config", None)
+    quant_config = getattr(config, "quantization_config", None)
+    sdnq = f'{shared.opts.sdnq_quantize_weights_mode}:{shared.opts.sdnq_quantize_weights_mode_te}:{shared.opts.sdnq_quantize_weights_group_size}' if quant == 'SDNQ' else ''
+    # checkpoint name may be just pipeline class so add config fingerprint to avoid sharing sizes between different modules, no parameter walk
+    fingerprint = f'{zlib.crc32(str(config).encode()):08x}' if config is not None else ''
+    return f'{get_size_prefix(checkpoint_name, module_name)}{module.__class__.__name__}:{getattr(module, "dtype", None)}:{quant}:{sdnq}:{quant_config}:{fingerprint}'
+
+
 def get_signature(cls):
-    signature = inspect.signature(cls.__init__, follow_wrapped=True)
-    return signature.parameters
+    key = (cls, True) if isinstance(cls, type) else (cls.__class__, False) # instances share signature of their bound init
+    if key not in signature_cache:
+        signature_cache[key] = inspect.signature(cls.__init__, follow_wrapped=True).parameters
+    return signature_cache[key]
 
 
 def disable_offload(sd_model):
     if not getattr(sd_model, 'has_accelerate', False):
         return
+    disable_group_offload(sd_model)
     if hasattr(sd_model, "_internal_dict"):
         keys = sd_model._internal_dict.keys() # pylint: disable=protected-access
     else:
@@ -82,6 +176,8 @@ def set_diffuser_offload(sd_model, op:str='model', quiet:bool=False):
     if accelerate_dtype_byte_size is None:
         accelerate_dtype_byte_size = accelerate.utils.modeling.dtype_byte_size
         accelerate.utils.modeling.dtype_byte_size = dtype_byte_size
+    if shared.opts.diffusers_offload_mode != "group":
+        disable_group_offload(sd_model) # offload mode changed without model reload
     if shared.opts.diffusers_offload_mode == "none":
         if shared.sd_model_type in offload_warn or 'video' in shared.sd_model_type:
             shared.log.warning(f'Setting {op}: offload={shared.opts.diffusers_offload_mode} type={shared.sd_model.__class__.__name__} large model')
@@ -125,11 +221,65 @@ def set_diffuser_offload(sd_model, op:str='model', quiet:bool=False):
             set_accelerate(sd_model)
         except Exception as e:
             shared.log.error(f'Setting {op}: offload={shared.opts.diffusers_offload_mode} {e}')
+    if shared.opts.diffusers_offload_mode == "group":
+        sd_model = apply_group_offload(sd_model, op=op, quiet=quiet)
     if shared.opts.diffusers_offload_mode == "balanced":
         sd_model = apply_balanced_offload(sd_model)
     process_timer.add('offload', time.time() - t0)
 
 
+def remove_group_offload(module):
+    from diffusers.hooks import HookRegistry
+    registry = HookRegistry.check_if_exists_or_initialize(module)
+    for hook in ['group_offloading', 'layer_execution_tracker', 'lazy_prefetch_group_offloading']:
+        registry.remove_hook(hook, recurse=True)
+    module.group_offload = None
+
+
+def disable_group_offload(sd_model):
+    components = sd_model.components if hasattr(sd_model, "components") else {}
+    for name, module in components.items():
+        if getattr(module, "group_offload", None) is None:
+            continue
+        try:
+            remove_group_offload(module)
+        except Exception as e:
+            shared.log.error(f'Offload: type=group op=remove module={name} {e}')
+
+
+def apply_group_offload(sd_model, op:str='model', quiet:bool=False):
+    # block-level offload keeps only active groups of blocks on gpu instead of swapping entire modules
+    from diffusers.hooks import apply_group_offloading
+    blocks = shared.opts.diffusers_offload_group_blocks
+    use_stream = get_copy_stream() is not None
+    applied = []
+    components = sd_model.components if hasattr(sd_model, "components") else {}
+    for name, module in components.items():
+        if not isinstance(module, torch.nn.Module):
+            continue
+        # block grouping only covers blocks lists so top-level params of vae/te used outside forward would not be onloaded
+        offload_type = 'block_level' if name.startswith('transformer') or name.startswith('unet') else 'leaf_level'
+        current = getattr(module, "group_offload", None)
+        if current == (offload_type, blocks):
+            continue
+        try:
+            if current is not None: # settings changed so reapply
+                remove_group_offload(module)
+            module.to(devices.cpu)
+            if offload_type == 'block_level':
+                apply_group_offloading(module, onload_device=devices.device, offload_device=devices.cpu, offload_type=offload_type, num_blocks_per_group=blocks, use_stream=use_stream)
+            else:
+                apply_group_offloading(module, onload_device=devices.device, offload_device=devices.cpu, offload_type=offload_type, use_stream=use_stream)
+            module.group_offload = (offload_type, blocks)
+            applied.append(f'{name}:{offload_type}')
+        except Exception as e:
+            shared.log.error(f'Setting {op}: offload=group module={name} {e}')
+    if len(applied) > 0:
+        shared.log.quiet(quiet, f'Setting {op}: offload=group blocks={blocks} stream={use_stream} modules={applied}')
+    set_accelerate(sd_model)
+    return sd_model
+
+
 class OffloadHook(accelerate.hooks.ModelHook):
     def __init__(self, checkpoint_name):
         if shared.opts.diffusers_offload_max_gpu_memory > 1:
@@ -142,8 +292,15 @@ class OffloadHook(accelerate.hooks.ModelHook):
         self.cpu_watermark = shared.opts.diffusers_offload_max_cpu_memory
         self.gpu = int(shared.gpu_memory * shared.opts.diffusers_offload_max_gpu_memory * 1024*1024*1024)
         self.cpu = int(shared.cpu_memory * shared.opts.diffusers_offload_max_cpu_memory * 1024*1024*1024)
+        self.execution_device = torch.device(devices.device)
+        self.normalized_device = devices.normalize_device(self.execution_device)
+        self.device_index = self.execution_device.index if self.execution_device.index is not None else 0
+        self.max_memory = { self.device_index: self.gpu, "cpu": self.cpu }
         self.offload_map = {}
         self.param_map = {}
+        self.sizes_changed = False
+        self.offload_dirs = {}
+        self.sorted_modules = {}
         gpu = f'{(shared.gpu_memory * shared.opts.diffusers_offload_min_gpu_memory):.2f}-{(shared.gpu_memory * shared.opts.diffusers_offload_max_gpu_memory):.2f}:{shared.gpu_memory:.2f}'
         shared.log.info(f'Offload: type=balanced op=init watermark={self.min_watermark}-{self.max_watermark} gpu={gpu} cpu={shared.cpu_memory:.3f} limit={shared.opts.cuda_mem_fraction:.2f}')
         self.validate()
@@ -167,15 +324,53 @@ class OffloadHook(accelerate.hooks.ModelHook):
     def model_size(self):
         return sum(self.offload_map.values())
 
+    def offload_dir(self, module_name):
+        key = (shared.opts.accelerate_offload_path, module_name)
+        if key not in self.offload_dirs:
+            self.offload_dirs[key] = os.path.join(shared.opts.accelerate_offload_path, self.checkpoint_name, module_name)
+        return self.offload_dirs[key]
+
+    def offload(self, module, non_blocking=False):
+        # copy into pinned buffers kept on each parameter so repeated offloads reuse them and later h2d copies are truly async
+        if not shared.opts.diffusers_offload_pin_memory or get_copy_stream() is None or getattr(module, "quantization_method", None) == 'bitsandbytes':
+            return module.to(devices.cpu)
+        params, sources, buffers = [], [], []
+        for param in module.parameters():
+            if param.device.type == 'cpu' or type(param.data) is not torch.Tensor: # quantized tensor subclasses use regular move
+                continue
+            buffer = getattr(param, "offload_buffer", None)
+            if buffer is None or buffer.shape != param.shape or buffer.dtype != param.dtype or buffer.stride() != param.stride():
+                size = param.numel() * param.element_size()
+                if pinned_memory + size > int(shared.cpu_memory * balanced_offload_pinned * 1024**3):
+                    continue
+                buffer = torch.empty_like(param.data, device=devices.cpu, pin_memory=True)
+                param.offload_buffer = buffer
+                pin_buffer(buffer, size)
+            params.append(param)
+            sources.append(param.data)
+            buffers.append(buffer)
+        if non_blocking: # copy on side stream so it overlaps with next pipeline stage, completion is awaited by wait_offload
+            stream = get_copy_stream()
+            stream.wait_stream(torch.cuda.current_stream()) # weights may have been modified on compute stream
+            with torch.cuda.stream(stream):
+                copy_buffers(buffers, sources, non_blocking=True)
+            for source in sources:
+                source.record_stream(stream) # keep gpu memory reserved until copy completes
+            module.offload_event = stream.record_event()
+        else:
+            copy_buffers(buffers, sources)
+        for param, buffer in zip(params, buffers):
+            param.data = buffer
+        return module.to(devices.cpu) # moves buffers and any parameters that were not pinned
+
     def init_hook(self, module):
         return module
 
     def pre_forward(self, module, *args, **kwargs):
-        if not devices.same_device(module.device, devices.device):
-            device_index = torch.device(devices.device).index
-            if device_index is None:
-                device_index = 0
-            max_memory = { device_index: self.gpu, "cpu": self.cpu }
+        wait_offload(module)
+        device = module.device
+        if device != self.normalized_device and not devices.same_device(device, devices.device): # direct compare handles common case without parsing devices
+            max_memory = self.max_memory # limits are fixed for lifetime of hook so device map only needs to be inferred once per module
             device_map = getattr(module, "balanced_offload_device_map", None)
             if device_map is None or max_memory != getattr(module, "balanced_offload_max_memory", None):
                 # try:
@@ -189,23 +384,29 @@ class OffloadHook(accelerate.hooks.ModelHook):
                     if isinstance(device_map[v], int):
                         device_map[v] = f"{devices.device.type}:{device_map[v]}" # int implies CUDA or XPU device, but it will break DirectML backend so we add type
             if device_map is not None:
-                module = accelerate.dispatch_model(module, device_map=device_map, offload_dir=offload_dir)
-            module._hf_hook.execution_device = torch.device(devices.device) # pylint: disable=protected-access
+                # side stream only overlaps with compute for pinned sources, otherwise it just fragments allocator pools
+                if shared.opts.diffusers_offload_pin_memory and set(device_map.values()) == {self.device_index} and get_copy_stream() is not None and getattr(module, "quantization_method", None) != 'bitsandbytes':
+                    module = move_module(module, devices.device) # entire module fits so skip dispatch and copy on side stream
+                    module.hf_device_map = dict(device_map)
+                else:
+                    module = accelerate.dispatch_model(module, device_map=device_map, offload_dir=offload_dir)
+            module._hf_hook.execution_device = self.execution_device # pylint: disable=protected-access
             module.balanced_offload_device_map = device_map
             module.balanced_offload_max_memory = max_memory
         return args, kwargs
 
     def post_forward(self, module, output):
         if getattr(module, "offload_post", False) and module.device != devices.cpu:
-            used_gpu, used_ram = devices.torch_gc(fast=True)
+            used_gpu = get_used_gpu()
+            used_ram = memstats.memory_stats().get('ram', {}).get('used', 0) if debug else 0
             perc_gpu = used_gpu / shared.gpu_memory
             try:
                 module_size = self.model_size()
                 prev_gpu = used_gpu
-                offload_now = perc_gpu > shared.opts.diffusers_offload_min_gpu_memory
+                offload_now = perc_gpu > shared.opts.diffusers_offload_min_gpu_memory and is_movable(module)
                 if offload_now:
-                    module = module.to(devices.cpu)
-                    used_gpu -= module_size
+                    module = self.offload(module, non_blocking=True)
+                    used_gpu = get_used_gpu()
                 if debug:
                     cls = module.__class__.__name__
                     quant = getattr(module, "quantization_method", None)
@@ -214,7 +415,7 @@ class OffloadHook(accelerate.hooks.ModelHook):
                 if 'out of memory' in str(e):
                     devices.torch_gc(fast=True, force=True, reason='oom')
                 elif 'bitsandbytes' in str(e):
-                    pass
+                    module.offload_unmovable = True # remember so next steps skip the move
                 else:
                     shared.log.error(f'Offload: type=balanced op=apply module={module.__name__} {e}')
                 if os.environ.get('SD_MOVE_DEBUG', None):
@@ -251,50 +452,75 @@ def apply_balanced_offload(sd_model=None, exclude=[]):
             modules_names = pipe._internal_dict.keys() # pylint: disable=protected-access
         else:
             modules_names = get_signature(pipe).keys()
-        modules_names = [m for m in modules_names if m not in exclude and not m.startswith('_')]
+        modules_names = tuple(m for m in modules_names if m not in exclude and not m.startswith('_') and isinstance(getattr(pipe, m, None), torch.nn.Module))
+        key = (pipe.__class__.__name__, modules_names)
+        if key in offload_hook_instance.sorted_modules: # sizes are fixed for hook lifetime so order only changes with module set
+            return offload_hook_instance.sorted_modules[key]
         modules = {}
         for module_name in modules_names:
             module_size = offload_hook_instance.offload_map.get(module_name, None)
             if module_size is None:
                 module = getattr(pipe, module_name, None)
-                if not isinstance(module, torch.nn.Module):
-                    continue
-                try:
-                    module_size = sum(p.numel() * p.element_size() for p in module.parameters(recurse=True)) / 1024 / 1024 / 1024
-                    param_num = sum(p.numel() for p in module.parameters(recurse=True)) / 1024 / 1024 / 1024
-                except Exception as e:
-                    shared.log.error(f'Offload: type=balanced op=calc module={module_name} {e}')
+                size_key = get_size_key(checkpoint_name, module_name, module)
+                stored = hashes.cache('offload').get(size_key, None)
+                if stored is not None:
+                    module_size, param_num = stored
+                else:
                     module_size = 0
+                    param_num = 0
+                    try:
+                        for p in module.parameters(recurse=True): # single pass for both size and count
+                            numel = p.numel()
+                            param_num += numel
+                            module_size += numel * p.element_size()
+                        module_size = module_size / 1024 / 1024 / 1024
+                        param_num = param_num / 1024 / 1024 / 1024
+                        sizes = hashes.cache('offload')
+                        prefix = get_size_prefix(checkpoint_name, module_name)
+                        for stale in [k for k in sizes if k.startswith(prefix)]: # keep only latest variant of each module
+                            del sizes[stale]
+                        sizes[size_key] = [module_size, param_num]
+                        offload_hook_instance.sizes_changed = True
+                    except Exception as e:
+                        shared.log.error(f'Offload: type=balanced op=calc module={module_name} {e}')
+                        module_size = 0
+                        param_num = 0
                 offload_hook_instance.offload_map[module_name] = module_size
                 offload_hook_instance.param_map[module_name] = param_num
             modules[module_name] = module_size
         modules = sorted(modules.items(), key=lambda x: x[1], reverse=True)
+        offload_hook_instance.sorted_modules[key] = modules
         return modules
 
     def apply_balanced_offload_to_module(pipe):
         # shared.log.trace(f'Offload: type=balanced op=apply pipe={pipe.__class__.__name__}')
-        used_gpu, used_ram = devices.torch_gc(fast=True)
-        if hasattr(pipe, "_internal_dict"):
-            keys = pipe._internal_dict.keys() # pylint: disable=protected-access
-        else:
-            keys = get_signature(pipe).keys()
-        keys = [k for k in keys if k not in exclude and not k.startswith('_')]
+        used_gpu = get_used_gpu()
+        if shared.cmd_opts.lowvram or (shared.gpu_memory > 0 and 100 * used_gpu / shared.gpu_memory >= shared.opts.torch_gc_threshold):
+            used_gpu = devices.torch_gc(fast=True)[0] # keep previous gc behavior under memory pressure
+        used_ram = memstats.memory_stats().get('ram', {}).get('used', 0) if debug else 0
+        offloaded = 0
         for module_name, module_size in get_pipe_modules(pipe): # pylint: disable=protected-access
             # shared.log.trace(f'Offload: type=balanced op=apply pipe={pipe.__class__.__name__} module={module_name} size={module_size:.3f}')
             module = getattr(pipe, module_name, None)
             if module is None:
                 continue
+            wait_offload(module)
+            module.offload_post = shared.sd_model_type in offload_post and shared.opts.te_hijack and module_name.startswith("text_encoder")
+            perc_gpu = used_gpu / shared.gpu_memory
+            stays = (perc_gpu <= shared.opts.diffusers_offload_min_gpu_memory) or (getattr(module, "device", None) == devices.cpu) or not is_movable(module)
+            if stays and getattr(module, "_hf_hook", None) is offload_hook_instance: # nothing to move and current hook is already attached
+                continue
             network_layer_name = getattr(module, "network_layer_name", None)
             device_map = getattr(module, "balanced_offload_device_map", None)
             max_memory = getattr(module, "balanced_offload_max_memory", None)
             module = accelerate.hooks.remove_hook_from_module(module, recurse=True)
-            perc_gpu = used_gpu / shared.gpu_memory
             try:
                 prev_gpu = used_gpu
-                offload_now = (perc_gpu > shared.opts.diffusers_offload_min_gpu_memory) and (module.device != devices.cpu)
+                offload_now = (perc_gpu > shared.opts.diffusers_offload_min_gpu_memory) and (module.device != devices.cpu) and is_movable(module)
                 if offload_now:
-                    module = module.to(devices.cpu)
-                    used_gpu -= module_size
+                    module = offload_hook_instance.offload(module)
+                    used_gpu = get_used_gpu() # actual usage instead of estimate since not all weights may move
+                    offloaded += module_size
                 cls = module.__class__.__name__
                 quant = getattr(module, "quantization_method", None)
                 if not cached:
@@ -305,21 +531,22 @@ def apply_balanced_offload(sd_model=None, exclude=[]):
                 if 'out of memory' in str(e):
                     devices.torch_gc(fast=True, force=True, reason='oom')
                 elif 'bitsandbytes' in str(e):
-                    pass
+                    module.offload_unmovable = True # remember so next steps skip the move
                 else:
                     shared.log.error(f'Offload: type=balanced op=apply module={module_name} {e}')
                 if os.environ.get('SD_MOVE_DEBUG', None):
                     errors.display(e, f'Offload: type=balanced op=apply module={module_name}')
-            module.offload_dir = os.path.join(shared.opts.accelerate_offload_path, checkpoint_name, module_name)
+            module.offload_dir = offload_hook_instance.offload_dir(module_name)
             module = accelerate.hooks.add_hook_to_module(module, offload_hook_instance, append=True)
-            module._hf_hook.execution_device = torch.device(devices.device) # pylint: disable=protected-access
+            module._hf_hook.execution_device = offload_hook_instance.execution_device # pylint: disable=protected-access
+            module.has_accelerate = True # flag per module since components can be swapped while hook instance is cached
             if network_layer_name:
                 module.network_layer_name = network_layer_name
             if device_map and max_memory:
                 module.balanced_offload_device_map = device_map
                 module.balanced_offload_max_memory = max_memory
-            module.offload_post = shared.sd_model_type in offload_post and shared.opts.te_hijack and module_name.startswith("text_encoder")
-        devices.torch_gc(fast=True, force=True, reason='offload')
+        if offloaded > balanced_offload_gc: # only release cache when enough memory was actually freed
+            devices.torch_gc(fast=True, force=True, reason='offload')
 
     apply_balanced_offload_to_module(sd_model)
     if hasattr(sd_model, "pipe"):
@@ -328,13 +555,18 @@ def apply_balanced_offload(sd_model=None, exclude=[]):
         apply_balanced_offload_to_module(sd_model.prior_pipe)
     if hasattr(sd_model, "decoder_pipe"):
         apply_balanced_offload_to_module(sd_model.decoder_pipe)
+    if offload_hook_instance.sizes_changed:
+        hashes.dump_cache()
+        offload_hook_instance.sizes_changed = False
     if shared.opts.layerwise_quantization:
         model_quant.apply_layerwise(sd_model, quiet=True) # need to reapply since hooks were removed/readded
-    set_accelerate(sd_model)
+    if not cached or not getattr(sd_model, "has_accelerate", False): # flags only need to be set once per hook instance
+        set_accelerate(sd_model)
     t = time.time() - t0
     process_timer.add('offload', t)
-    fn = f'{sys._getframe(2).f_code.co_name}:{sys._getframe(1).f_code.co_name}' # pylint: disable=protected-access
-    debug_move(f'Apply offload: time={t:.2f} type=balanced fn={fn}')
+    if debug:
+        fn = f'{sys._getframe(2).f_code.co_name}:{sys._getframe(1).f_code.co_name}' # pylint: disable=protected-access
+        debug_move(f'Apply offload: time={t:.2f} type=balanced fn={fn}')
     if not cached:
         shared.log.info(f'Model class={sd_model.__class__.__name__} modules={len(offload_hook_instance.offload_map)} size={offload_hook_instance.model_size():.3f}')
     return sd_model